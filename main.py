@@ -10,7 +10,7 @@ from torch.nn.modules.module import Module
 import torch.optim as optim
 import torchvision
 from torchvision.io import ImageReadMode
-import torchvision.transforms as transforms
+import torchvision.transforms.functional as TF
 from torch.utils.data import Dataset, DataLoader
 from torch.optim import Optimizer
 from torchvision import datasets
@@ -18,7 +18,10 @@ from torchvision import transforms as T
 from torch.optim.lr_scheduler import StepLR
 
 import glob
+import hashlib
+import math
 import os
+import tempfile
 from sklearn.model_selection import StratifiedShuffleSplit
 from PIL import Image
 
@@ -37,8 +40,7 @@ class ResnetBackbone(nn.Module):
         self.bone = torch.nn.Sequential(*(list(self.bone.children())[:-1]))
         
     def forward(self, x):
-        output = self.bone(x)
-        output = output.view(output.size()[0], -1)
+        output = self.bone(x).flatten(1)
         return output
 
 class SiameseNetwork(nn.Module):
@@ -46,11 +48,11 @@ class SiameseNetwork(nn.Module):
         Siamese network for image similarity estimation.
         The network is composed of two identical networks, one for each input.
         The output of each network is concatenated and passed to a linear layer. 
-        The output of the linear layer passed through a sigmoid function.
+        The output of the linear layer is a logit; the sigmoid is fused into `BCEWithLogitsLoss`.
         `"FaceNet" <https://arxiv.org/pdf/1503.03832.pdf>`_ is a variant of the Siamese network.
         This implementation varies from FaceNet as we use the `ResNet-18` model from
         `"Deep Residual Learning for Image Recognition" <https://arxiv.org/pdf/1512.03385.pdf>`_ as our feature extractor.
-        In addition, we aren't using `TripletLoss` as the MNIST dataset is simple, so `BCELoss` can do the trick.
+        In addition, we aren't using `TripletLoss` as the MNIST dataset is simple, so `BCEWithLogitsLoss` can do the trick.
     """
     def __init__(self):
         super(SiameseNetwork, self).__init__()
@@ -65,8 +67,6 @@ class SiameseNetwork(nn.Module):
             nn.Linear(256, 1),
         )
 
-        self.sigmoid = nn.Sigmoid()
-
         # initialize the weights
         self.back.bone.apply(self.init_weights)
         self.fc.apply(self.init_weights)
@@ -77,9 +77,10 @@ class SiameseNetwork(nn.Module):
             m.bias.data.fill_(0.01)
 
     def forward(self, input1, input2):
-        # get two images' features
-        output1 = self.back(input1)
-        output2 = self.back(input2)
+        # get two images' features with a single backbone pass over both batches
+        batch_size = input1.size(0)
+        features = self.back(torch.cat((input1, input2), 0))
+        output1, output2 = features[:batch_size], features[batch_size:]
 
         # concatenate both images' features
         output = torch.cat((output1, output2), 1)
@@ -87,35 +88,112 @@ class SiameseNetwork(nn.Module):
         # pass the concatenation to the linear layers
         output = self.fc(output)
 
-        # pass the out of the linear layers to sigmoid layer
-        output = self.sigmoid(output)
-        
         return output
 
+class _DecodeDS(Dataset):
+    # throwaway dataset used only to decode the images in parallel
+    def __init__(self, file_names: list[str], final_height: int, final_width: int):
+        super(_DecodeDS, self).__init__()
+        self.file_names = file_names
+        self.final_height = final_height
+        self.final_width = final_width
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def __getitem__(self, index):
+        return index, IrisDataset.load_image(self.file_names[index], self.final_height, self.final_width)
+
 class IrisDataset(Dataset):
-    def __init__(self, file_names: list[str], labels: torch.Tensor, transform, rng, final_height, final_width):
+    # bump whenever `load_image` changes, to invalidate old caches
+    CACHE_VERSION = 1
+
+    def __init__(self, file_names: list[str], labels: torch.Tensor, final_height, final_width,
+                 cache_dir: str = '.cache'):
         super(IrisDataset, self).__init__()
-        # Transformações usadas no dataset
-        size = len(file_names)
-        self.images = torch.empty([size, 1, final_height, final_width], dtype=torch.float32)
-        
-        for file_name in file_names:
-            img = Image.open(file_name)
-            img: torch.Tensor = transform(img)
-            self.images[0] = img
+        cache_path = os.path.join(cache_dir, f'iris_{self.cache_key(file_names, final_height, final_width)}.pt')
+
+        if os.path.exists(cache_path):
+            self.images = torch.load(cache_path, mmap=True)
+        else:
+            self.images = self.decode_images(file_names, final_height, final_width)
+            # save to a temporary file and only then move it into place, so an
+            # interrupted run can't leave a truncated cache behind
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    torch.save(self.images, f)
+                os.replace(tmp_path, cache_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
 
         self.labels = labels
         self.classes = labels.unique()
-        img_index = np.arange(len(self.labels))
-        img_index = np.split(img_index, len(self.classes))
-        
-        self.image_dict = {
-            int(array.item()): index for index in img_index
-            for array in self.classes
-        }
-        
-        self.rng = rng
+        num_classes = len(self.classes)
+        self.class_indices, self.class_sizes = self._build_class_index(labels)
+        # positive pairs need two distinct images of the same class
+        if int(self.class_sizes.min()) < 2:
+            raise ValueError('every class needs at least 2 images to build positive pairs, '
+                             f'got class sizes {self.class_sizes.tolist()}')
+
+        # for each class, the other classes, to draw negative pairs without rejection sampling
+        classes = np.arange(num_classes)
+        self.class_to_others = torch.as_tensor(
+            np.stack([np.delete(classes, c) for c in classes]), dtype=torch.long
+        )
 
+        # targets are shared between samples instead of allocated on every `__getitem__`
+        self.positive_target = torch.tensor(1, dtype=torch.float)
+        self.negative_target = torch.tensor(0, dtype=torch.float)
+
+    @classmethod
+    def cache_key(cls, file_names: list[str], final_height: int, final_width: int) -> str:
+        # the file order defines each image's index, so it is part of the key; the file
+        # bytes are hashed too, so an image replaced at the same path invalidates the cache
+        key = hashlib.sha1(f'{cls.CACHE_VERSION}\n{final_height}\n{final_width}\n'.encode())
+        for file_name in file_names:
+            key.update(f'{file_name}\n'.encode())
+            with open(file_name, 'rb') as f:
+                key.update(hashlib.sha1(f.read()).digest())
+        return key.hexdigest()
+
+    @staticmethod
+    def _build_class_index(labels: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        # row c holds the image indices of the c-th class, zero-padded up to the largest
+        # class; only the first `class_sizes[c]` positions are ever sampled
+        labels = labels.numpy()
+        img_index = [np.flatnonzero(labels == c) for c in np.unique(labels)]
+        class_sizes = torch.tensor([len(index) for index in img_index], dtype=torch.long)
+        class_indices = torch.zeros([len(img_index), int(class_sizes.max())], dtype=torch.long)
+        for c, index in enumerate(img_index):
+            class_indices[c, :len(index)] = torch.from_numpy(index)
+        return class_indices, class_sizes
+
+    @staticmethod
+    def decode_images(file_names: list[str], final_height: int, final_width: int) -> torch.Tensor:
+        images = torch.empty([len(file_names), 1, final_height, final_width], dtype=torch.float32)
+
+        # decode in several processes and scatter each batch into the buffer by index;
+        # there is no point in more workers than batches, and the loader is discarded
+        # at the end so no workers stay alive
+        batch_size = 32
+        num_workers = min(os.cpu_count() or 0, math.ceil(len(file_names) / batch_size))
+        decode_loader = DataLoader(_DecodeDS(file_names, final_height, final_width),
+                                   batch_size=batch_size, num_workers=num_workers)
+        for indices, imgs in decode_loader:
+            images[indices] = imgs
+        del decode_loader
+        return images
+
+    @staticmethod
+    def load_image(file_name: str, final_height: int, final_width: int) -> torch.Tensor:
+        # torchvision.io can't decode BMP, so PIL only decodes and the rest runs on tensors
+        with Image.open(file_name) as img:
+            img = torch.from_numpy(np.array(img.convert('L'))).unsqueeze(0)
+        img = TF.resize(img, [final_height, final_width], antialias=True)
+        return img.to(torch.float32).div_(255)
  
     def __len__(self):
         return len(self.images)
@@ -136,52 +214,85 @@ class IrisDataset(Dataset):
         """
 
         # pick some random class for the first image
-        selected_class = self.rng.choice(self.classes)
+        selected_class = int(torch.randint(len(self.classes), ()))
+        class_size = int(self.class_sizes[selected_class])
 
         # pick a random index for the first image in the grouped indices based of the label
         # of the class
-        
-        index_1 = self.rng.choice(self.image_dict[selected_class])
+        position_1 = int(torch.randint(class_size, ()))
+        index_1 = int(self.class_indices[selected_class, position_1])
 
         # get the first image
         image_1 = self.images[index_1]
 
         # same class
         if index % 2 == 0:
-            # pick a random index for the second image
-            index_2 = self.rng.choice(self.image_dict[selected_class])
-            
-            # ensure that the index of the second image isn't the same as the first image
-            while index_2 == index_1:
-                index_2 = self.rng.choice(self.image_dict[selected_class])
+            # pick a random index for the second image among the other images of the class,
+            # skipping over the first one so it can't be picked twice
+            position_2 = int(torch.randint(class_size - 1, ()))
+            position_2 += position_2 >= position_1
+            index_2 = int(self.class_indices[selected_class, position_2])
             
             # get the second image
             image_2 = self.images[index_2]
 
             # set the label for this example to be positive (1)
-            target = torch.tensor(1, dtype=torch.float)
+            target = self.positive_target
         
         # different class
         else:
-            # pick a random class
-            other_selected_class = self.rng.choice(self.classes)
-
-            # ensure that the class of the second image isn't the same as the first image
-            while other_selected_class == selected_class:
-                other_selected_class = self.rng.choice(self.classes)
+            # pick a random class other than the class of the first image
+            other_position = int(torch.randint(len(self.classes) - 1, ()))
+            other_selected_class = int(self.class_to_others[selected_class, other_position])
 
-            
             # pick a random index for the second image in the grouped indices based of the label
             # of the class
-            index_2 = self.rng.choice(self.image_dict[other_selected_class])
+            position_2 = int(torch.randint(int(self.class_sizes[other_selected_class]), ()))
+            index_2 = int(self.class_indices[other_selected_class, position_2])
 
-            image_2 = self.images[index_2].clone().float()
+            image_2 = self.images[index_2]
 
             # set the label for this example to be negative (0)
-            target = torch.tensor(0, dtype=torch.float)
+            target = self.negative_target
 
         return image_1, image_2, target
 
+    def __getitems__(self, indices: list[int]):
+        """
+            Batched version of `__getitem__`: samples the whole minibatch with a handful of
+            tensor ops and returns it already collated, so it must be paired with `collate`.
+        """
+        indices = torch.as_tensor(indices)
+        batch_size = len(indices)
+
+        # pick the class and the first image of every pair
+        selected_class = torch.randint(len(self.classes), (batch_size,))
+        class_size = self.class_sizes[selected_class]
+        position_1 = (torch.rand(batch_size) * class_size).long()
+        index_1 = self.class_indices[selected_class, position_1]
+
+        # same class: another image of the class, skipping over the first one
+        position_2 = (torch.rand(batch_size) * (class_size - 1)).long()
+        position_2 += position_2 >= position_1
+        same_index_2 = self.class_indices[selected_class, position_2]
+
+        # different class: any image of any other class
+        other_position = torch.randint(len(self.classes) - 1, (batch_size,))
+        other_selected_class = self.class_to_others[selected_class, other_position]
+        position_2 = (torch.rand(batch_size) * self.class_sizes[other_selected_class]).long()
+        diff_index_2 = self.class_indices[other_selected_class, position_2]
+
+        # even indices are positive examples, odd indices are negative ones
+        positive = indices % 2 == 0
+        index_2 = torch.where(positive, same_index_2, diff_index_2)
+
+        return self.images[index_1], self.images[index_2], positive.float()
+
+    @staticmethod
+    def collate(batch):
+        # `__getitems__` already returns a collated batch
+        return batch
+
 
 def train_loop(train_loader: DataLoader,
                model: nn.Module,
@@ -191,16 +302,22 @@ def train_loop(train_loader: DataLoader,
                epochs: int,
                log_interval: int,
                dry_run: bool,
+               use_amp: bool,
                **kwargs):
     model.train()
+    memory_format = torch.channels_last if use_amp else torch.contiguous_format
+    autocast = torch.autocast('cuda', dtype=torch.bfloat16, enabled=use_amp)
 
-    # we aren't using `TripletLoss` as the MNIST dataset is simple, so `BCELoss` can do the trick.
+    # we aren't using `TripletLoss` as the MNIST dataset is simple, so `BCEWithLogitsLoss` can do the trick.
 
     for batch_idx, (images_1, images_2, targets) in enumerate(train_loader):
-        images_1, images_2, targets = images_1.to(device), images_2.to(device), targets.to(device)
-        optimizer.zero_grad()
-        outputs = model(images_1, images_2).squeeze()
-        loss = loss_fn(outputs, targets)
+        images_1 = images_1.to(device, non_blocking=True).contiguous(memory_format=memory_format)
+        images_2 = images_2.to(device, non_blocking=True).contiguous(memory_format=memory_format)
+        targets = targets.to(device, non_blocking=True)
+        optimizer.zero_grad(set_to_none=True)
+        with autocast:
+            outputs = model(images_1, images_2).squeeze(1)
+            loss = loss_fn(outputs, targets)
         loss.backward()
         optimizer.step()
         if batch_idx % log_interval == 0:
@@ -216,14 +333,16 @@ def test_loop(test_loader: DataLoader, model: nn.Module, loss_fn: nn.Module, dev
     test_loss = 0
     correct = 0
 
-    # we aren't using `TripletLoss` as the MNIST dataset is simple, so `BCELoss` can do the trick.
+    # we aren't using `TripletLoss` as the MNIST dataset is simple, so `BCEWithLogitsLoss` can do the trick.
 
-    with torch.no_grad():
+    with torch.inference_mode():
         for (images_1, images_2, targets) in test_loader:
-            images_1, images_2, targets = images_1.to(device), images_2.to(device), targets.to(device)
-            outputs = model(images_1, images_2).squeeze()
+            images_1 = images_1.to(device, non_blocking=True)
+            images_2 = images_2.to(device, non_blocking=True)
+            targets = targets.to(device, non_blocking=True)
+            outputs = model(images_1, images_2).squeeze(1)
             test_loss += loss_fn(outputs, targets).sum().item()  # sum up batch loss
-            pred = torch.where(outputs > 0.5, 1, 0)  # get the index of the max log-probability
+            pred = torch.where(outputs > 0.0, 1, 0)  # get the index of the max log-probability
             correct += pred.eq(targets.view_as(pred)).sum().item()
 
     test_loss /= len(test_loader.dataset)
@@ -236,6 +355,15 @@ def test_loop(test_loader: DataLoader, model: nn.Module, loss_fn: nn.Module, dev
         100. * correct / len(test_loader.dataset)))
 
 
+def freeze_for_inference(model: nn.Module) -> torch.jit.ScriptModule:
+    # freeze folds each BatchNorm into the preceding conv; the eager model is kept
+    # for training since BN must keep updating its running stats. Evaluation runs in
+    # float32, where NHWC brings no gain, so the copy is frozen in NCHW
+    model = copy.deepcopy(model).to(memory_format=torch.contiguous_format)
+    model.eval()
+    return torch.jit.freeze(torch.jit.script(model))
+
+
 def main():
     # Training settings
     parser = argparse.ArgumentParser(description='PyTorch Siamese network Example')
@@ -265,6 +393,8 @@ def main():
     
     use_cuda = not args.no_cuda and torch.cuda.is_available()
     use_mps = not args.no_mps and torch.backends.mps.is_available()
+    # bfloat16 has the same range as float32, so no GradScaler is needed
+    use_amp = use_cuda and torch.cuda.is_bf16_supported()
 
     torch.manual_seed(args.seed)
 
@@ -275,20 +405,25 @@ def main():
     else:
         device = torch.device("cpu")
 
-    train_kwargs = {'batch_size': args.batch_size}
-    test_kwargs = {'batch_size': args.test_batch_size}
+    train_kwargs = {'batch_size': args.batch_size, 'collate_fn': IrisDataset.collate}
+    test_kwargs = {'batch_size': args.test_batch_size, 'collate_fn': IrisDataset.collate}
     if use_cuda:
-        cuda_kwargs = {'num_workers': 1,
+        cuda_kwargs = {'num_workers': min(8, os.cpu_count() or 1),
                        'pin_memory': True,
-                       'shuffle': True}
+                       'shuffle': True,
+                       'persistent_workers': True,
+                       'prefetch_factor': 2}
         train_kwargs.update(cuda_kwargs)
         test_kwargs.update(cuda_kwargs)
 
     DATASET_DIR = 'MMU-Iris-Database'
-    class_names = np.sort(np.array(next(os.walk(DATASET_DIR))[1], np.float32))
-    file_paths = np.sort(glob.glob(DATASET_DIR + '/*/*.bmp'))
+    # the files are already grouped by class directory, so the labels are just
+    # each directory's name repeated once per file in it
+    class_names = np.sort(next(os.walk(DATASET_DIR))[1])
+    class_files = [sorted(glob.glob(os.path.join(DATASET_DIR, name, '*.bmp'))) for name in class_names]
+    file_paths = np.array([path for files in class_files for path in files])
 
-    labels = np.array([path.split('/')[1] for path in file_paths], np.float32)
+    labels = np.repeat(class_names.astype(np.float32), [len(files) for files in class_files])
     labels -= 1
     
     splitter = StratifiedShuffleSplit(n_splits=1, train_size=0.6, test_size=0.4, random_state=args.seed)
@@ -299,36 +434,40 @@ def main():
 
     # num_classes = np.unique(labels_train).shape[0]+1
     
-    sort_index = np.argsort(labels_train)
-    labels_train = labels_train[sort_index]
-    files_train = files_train[sort_index]
+    # label-major, path-minor order in a single sort so each class is a contiguous block
+    order = np.lexsort((files_train, labels_train))
+    labels_train = labels_train[order]
+    files_train = files_train[order]
     
-    sort_index = np.argsort(labels_test)
-    labels_test = labels_test[sort_index]
-    files_test = files_test[sort_index]
+    order = np.lexsort((files_test, labels_test))
+    labels_test = labels_test[order]
+    files_test = files_test[order]
     
     labels_train = torch.from_numpy(labels_train)
     labels_test = torch.from_numpy(labels_test)    
     
-    rng = np.random.default_rng(args.seed)
     FINAL_HEIGHT = 128
     FINAL_WIDTH = 128
-    ds_transforms = transforms.Compose([transforms.Grayscale(num_output_channels=1), 
-                                        transforms.Resize((FINAL_HEIGHT, FINAL_WIDTH)),
-                                        transforms.ToTensor()])
-    train_dataset = IrisDataset(files_train, labels_train, ds_transforms, rng, FINAL_HEIGHT, FINAL_WIDTH)
-    test_dataset = IrisDataset(files_test, labels_test, ds_transforms, rng, FINAL_HEIGHT, FINAL_WIDTH)
+    train_dataset = IrisDataset(files_train, labels_train, FINAL_HEIGHT, FINAL_WIDTH)
+    test_dataset = IrisDataset(files_test, labels_test, FINAL_HEIGHT, FINAL_WIDTH)
     train_loader = DataLoader(train_dataset,**train_kwargs)
     test_loader = DataLoader(test_dataset, **test_kwargs)
 
     model = SiameseNetwork().to(device)
-    optimizer = optim.Adadelta(model.parameters(), lr=args.lr)
-    loss_fn = nn.BCELoss()
+    if use_amp:
+        # NHWC lets cuDNN use its tensor-core convolution kernels under bfloat16 autocast;
+        # in float32 it brings no gain, so it follows the same condition
+        model = model.to(memory_format=torch.channels_last)
+    # the compiled wrapper shares parameters with `model`; the eager module is kept
+    # for TorchScript freezing and for saving a state_dict without the compile prefix
+    train_model = torch.compile(model, mode='max-autotune') if use_cuda else model
+    optimizer = optim.Adadelta(model.parameters(), lr=args.lr, foreach=True)
+    loss_fn = nn.BCEWithLogitsLoss()
 
     scheduler = StepLR(optimizer, step_size=1, gamma=args.gamma)
     for epoch in range(1, args.epochs + 1):
-        train_loop(train_loader, model, loss_fn, optimizer, device, **vars(args))
-        test_loop(test_loader, model, loss_fn, device)
+        train_loop(train_loader, train_model, loss_fn, optimizer, device, use_amp=use_amp, **vars(args))
+        test_loop(test_loader, freeze_for_inference(model), loss_fn, device)
         scheduler.step()
 
     if args.save_model: